@@ -42,10 +42,19 @@ from linebot.v3.webhooks import (
 )
 import os
 import psycopg2
+import psycopg2.extras
+import psycopg2.errors
 import json
 import requests
 import urllib.parse
 import time
+import threading
+import hashlib
+import re
+import functools
+from collections import OrderedDict
+from array import array
+from datetime import datetime, timedelta, timezone
 
 # 記錄使用者當前狀態的字典 (Key: user_id, Value: 狀態字串)
 user_states = {}
@@ -56,7 +65,243 @@ configuration = Configuration(access_token=os.getenv('CHANNEL_ACCESS_TOKEN'))
 line_handler = WebhookHandler(os.getenv('CHANNEL_SECRET'))
 
 
-def get_courses_list(day_name):
+class TTLCache:
+    # 有容量上限、會自動過期的 key 集合 (存活時間固定，所以插入順序就是過期順序)
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._expires = OrderedDict()  # Key: key, Value: 過期時間
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        # 新增成功回傳 True；key 已存在且尚未過期則回傳 False
+        now = time.monotonic()
+        with self._lock:
+            while self._expires and next(iter(self._expires.values())) <= now:
+                self._expires.popitem(last=False)
+            if key in self._expires:
+                return False
+            self._expires[key] = now + self.ttl
+            if len(self._expires) > self.maxsize:
+                self._expires.popitem(last=False)  # 超過上限時淘汰最舊的
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._expires.pop(key, None)
+
+
+class SingleFlight:
+    # 相同 key 的並行呼叫只會真正執行一次，其餘呼叫等待並共用同一個結果
+    def __init__(self):
+        self._calls = {}  # Key: key, Value: 進行中的呼叫
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not is_leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func(*args)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+# 已處理過的 webhookEventId，LINE 逾時重送時會帶著相同的 id
+handled_events = TTLCache(maxsize=10000, ttl=600)
+# 並行中相同的上游 API 請求或資料庫查詢只跑一次
+single_flight = SingleFlight()
+
+
+def skip_redelivered(func):
+    @functools.wraps(func)
+    def wrapper(event):
+        event_id = event.webhook_event_id
+        if event_id and not handled_events.add(event_id):
+            app.logger.info(f"Skip redelivered event: {event_id}")
+            return
+        try:
+            return func(event)
+        except Exception:
+            handled_events.discard(event_id)  # 處理失敗時允許 LINE 重送後再處理一次
+            raise
+    return wrapper
+
+
+def fetch_json(url):
+    return requests.get(url).json()
+
+
+# 流量控制設定，可用環境變數調整
+RATE_LIMIT_PER_SEC = float(os.getenv('RATE_LIMIT_PER_SEC', '1'))     # 每位使用者每秒補充的次數
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '5'))            # 每位使用者可連續觸發的次數
+MAX_INFLIGHT_EVENTS = int(os.getenv('MAX_INFLIGHT_EVENTS', '8'))      # 同時處理的事件上限
+MAX_QUEUED_EVENTS = int(os.getenv('MAX_QUEUED_EVENTS', '16'))         # 排隊等待的事件上限
+QUEUE_WAIT_SECONDS = float(os.getenv('QUEUE_WAIT_SECONDS', '2'))      # 排隊最多等待的秒數
+
+
+class TokenBucketLimiter:
+    # 每位使用者一個 token bucket，超過 maxsize 時淘汰最久沒出現的使用者
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # Key: user_id, Value: (剩餘 token, 上次更新時間)
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return allowed
+
+
+class WorkQueue:
+    # 限制同時處理的事件數，排隊的事件數也有上限，超過就直接丟棄 (load shedding)
+    def __init__(self, max_inflight, max_queued, wait_seconds):
+        self.max_queued = max_queued
+        self.wait_seconds = wait_seconds
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._slots.acquire(blocking=False):
+            return True
+        with self._lock:
+            if self._queued >= self.max_queued:
+                return False
+            self._queued += 1
+        try:
+            return self._slots.acquire(timeout=self.wait_seconds)
+        finally:
+            with self._lock:
+                self._queued -= 1
+
+    def release(self):
+        self._slots.release()
+
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_PER_SEC, RATE_LIMIT_BURST)
+work_queue = WorkQueue(MAX_INFLIGHT_EVENTS, MAX_QUEUED_EVENTS, QUEUE_WAIT_SECONDS)
+
+# 流量控制統計 (放行 / 限流 / 丟棄)
+admission_metrics = {'admitted': 0, 'throttled': 0, 'shed': 0}
+admission_metrics_lock = threading.Lock()
+
+
+def count_admission(name):
+    with admission_metrics_lock:
+        admission_metrics[name] += 1
+
+
+def reply_busy(event):
+    # 忙碌時只回一則簡單訊息，不碰資料庫和外部 API
+    try:
+        with ApiClient(configuration) as api_client:
+            MessagingApi(api_client).reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text="目前使用人數較多，請稍後再試一次")]
+                )
+            )
+    except Exception as e:
+        print(e)
+
+
+def admission_control(func):
+    @functools.wraps(func)
+    def wrapper(event):
+        user_id = event.source.user_id if event.source else None
+        if user_id and not rate_limiter.allow(user_id):
+            count_admission('throttled')
+            reply_busy(event)
+            return
+        if not work_queue.acquire():
+            count_admission('shed')
+            reply_busy(event)
+            return
+
+        count_admission('admitted')
+        try:
+            return func(event)
+        finally:
+            work_queue.release()
+    return wrapper
+
+
+# 個人課表 (Key: LINE user_id)，複合索引讓「查詢課表」維持單次索引查詢
+STUDENT_SCHEDULE_SQL = """
+    CREATE TABLE IF NOT EXISTS student_schedule (
+        user_id TEXT NOT NULL,
+        weekday TEXT NOT NULL,
+        time_slot TEXT NOT NULL,
+        course_name TEXT NOT NULL,
+        location TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_student_schedule_user_weekday_slot
+        ON student_schedule (user_id, weekday, time_slot);
+"""
+# 全班共用課表的索引，需要 schedule 的擁有者權限
+SHARED_SCHEDULE_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_schedule_weekday_slot
+        ON schedule (weekday, time_slot);
+"""
+# 還沒匯入過個人課表 (student_schedule 不存在) 時使用的查詢
+SHARED_SCHEDULE_SQL = """
+    SELECT course_name, time_slot, location
+    FROM schedule
+    WHERE weekday = %s
+    ORDER BY time_slot
+"""
+schedule_tables_ready = False  # 建立過資料表後就不再重複執行
+
+
+# 只在匯入課表時呼叫，查詢課表只需要 SELECT 權限
+def init_schedule_tables():
+    global schedule_tables_ready
+    if schedule_tables_ready:
+        return
+
+    supabase_url = os.getenv('DATABASE_URL')
+    conn = psycopg2.connect(supabase_url)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(STUDENT_SCHEDULE_SQL)
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(SHARED_SCHEDULE_INDEX_SQL)
+        except psycopg2.Error as e:
+            # 索引只是加速查詢，沒有權限建立也不影響匯入
+            print(f"資料庫錯誤: {e}")
+    finally:
+        conn.close()
+    schedule_tables_ready = True
+
+
+def get_courses_list(day_name, user_id=None):
     supabase_url = os.getenv('DATABASE_URL')
     
     try:
@@ -65,13 +310,24 @@ def get_courses_list(day_name):
         cur = conn.cursor()
         
         # 查詢課程，依照時間排序
+        # 有匯入個人課表的使用者查 student_schedule，否則退回全班共用的 schedule
         sql = """
-            SELECT course_name, time_slot, location 
-            FROM schedule 
-            WHERE weekday = %s 
+            SELECT course_name, time_slot, location
+            FROM student_schedule
+            WHERE user_id = %s AND weekday = %s
+            UNION ALL
+            SELECT course_name, time_slot, location
+            FROM schedule
+            WHERE weekday = %s
+              AND NOT EXISTS (SELECT 1 FROM student_schedule WHERE user_id = %s)
             ORDER BY time_slot
         """
-        cur.execute(sql, (day_name,))
+        try:
+            cur.execute(sql, (user_id, day_name, day_name, user_id))
+        except psycopg2.errors.UndefinedTable:
+            # 還沒匯入過個人課表，只查全班共用的 schedule
+            conn.rollback()
+            cur.execute(SHARED_SCHEDULE_SQL, (day_name,))
         rows = cur.fetchall()
         
         cur.close()
@@ -84,91 +340,263 @@ def get_courses_list(day_name):
         return []
 
 
-def get_thingspeak_temp_chart_url():
-    # 1. 設定 ThingSpeak 參數
-    channel_id = os.getenv('THINKSPEAK_TEMP_CHANNEL_ID')
-    read_api_key = os.getenv('THINKSPEAK_TEMP_READ_API_KEY')
-    RESULTS_NUM = 8  # 想要顯示最近的幾筆資料
-    
-    # 取得 ThingSpeak 原始數據 (JSON)
-    ts_url = f'https://api.thingspeak.com/channels/{channel_id}/fields/1.json?api_key={read_api_key}&results={RESULTS_NUM}&timezone=Asia/Taipei'
-    response = requests.get(ts_url).json()
-    
-    # 解析數據
-    feeds = response.get('feeds', [])
-    labels = [f["created_at"][11:16] for f in feeds]  # 取得時間 (例如 14:30)
-    data = [float(f["field1"]) if f["field1"] else 0 for f in feeds] # 取得數值
-    
-    # 2. 設定 QuickChart 配置 (Chart.js 語法)
-    chart_config = {
-        "type": "line",
-        "data": {
-            "labels": labels,
-            "datasets": [{
-                "label": "溫度(°C)",
-                "data": data,
-                "fill": True,
-                "backgroundColor": "rgba(54, 162, 235, 0.2)",
-                "borderColor": "rgb(54, 162, 235)",
-                "borderWidth": 2
-            }]
-        },
-        "options": {
-            "title": { 
-                "display": True,
-                "text": "ThingSpeak溫度數據"
-            },
-            "scales": {
-                "yAxes": [{
-                    "ticks": {
-                        "beginAtZero": False  # 只要設為 False，QuickChart 就會自動從資料的最小值附近開始畫
-                    }
-                }]
-            }
-        }
-    }
-    
-    # 將字典轉換為字串並進行 URL 編碼
-    json_str = json.dumps(chart_config)
-    encoded_config = urllib.parse.quote(json_str)
-    quickchart_url = f"https://quickchart.io/chart?c={encoded_config}&bkg=white"
-    
-    return quickchart_url
+def get_courses_batch(user_ids, day_name):
+    supabase_url = os.getenv('DATABASE_URL')
+    user_ids = list(user_ids)
+    result = {user_id: [] for user_id in user_ids}
 
+    try:
+        conn = psycopg2.connect(supabase_url)
+        cur = conn.cursor()
+
+        # 一次查出多位使用者當天的課程 (user_id = ANY 仍走複合索引)
+        # 沒有個人課表的使用者同樣退回全班共用的 schedule
+        sql = """
+            SELECT user_id, course_name, time_slot, location
+            FROM student_schedule
+            WHERE user_id = ANY(%s) AND weekday = %s
+            UNION ALL
+            SELECT u.user_id, g.course_name, g.time_slot, g.location
+            FROM unnest(%s::text[]) AS u(user_id)
+            JOIN schedule g ON g.weekday = %s
+            WHERE NOT EXISTS (SELECT 1 FROM student_schedule s WHERE s.user_id = u.user_id)
+            ORDER BY 1, 3
+        """
+        try:
+            cur.execute(sql, (user_ids, day_name, user_ids, day_name))
+            for user_id, course_name, time_slot, location in cur.fetchall():
+                result[user_id].append((course_name, time_slot, location))
+        except psycopg2.errors.UndefinedTable:
+            # 還沒匯入過個人課表，每位使用者都是全班共用的 schedule
+            conn.rollback()
+            cur.execute(SHARED_SCHEDULE_SQL, (day_name,))
+            rows = cur.fetchall()
+            for user_id in user_ids:
+                result[user_id] = list(rows)
+
+        cur.close()
+        conn.close()
+
+    except Exception as e:
+        print(f"資料庫錯誤: {e}")
+    return result # {user_id: [(課名, 時間, 地點), (...)]}
+
+
+def import_enrolment(payload):
+    # 支援兩種格式:
+    # 1. 逐筆課程: [{"user_id", "weekday", "time_slot", "course_name", "location"}, ...]
+    # 2. 整班選課: {"user_ids": [...], "courses": [{"weekday", "time_slot", "course_name", "location"}, ...]}
+    if isinstance(payload, dict):
+        rows = [(user_id, c['weekday'], c['time_slot'], c['course_name'], c.get('location'))
+                for user_id in payload['user_ids'] for c in payload['courses']]
+    else:
+        rows = [(c['user_id'], c['weekday'], c['time_slot'], c['course_name'], c.get('location'))
+                for c in payload]
+
+    # 任何一筆寫入都會蓋掉該使用者的共用課表，所以格式不對就整批拒絕 (ValueError → 400)
+    if not rows:
+        raise ValueError("沒有可匯入的課程")
+    for user_id, weekday, time_slot, course_name, location in rows:
+        if not isinstance(user_id, str) or not user_id.strip():
+            raise ValueError(f"user_id 不可為空: {user_id!r}")
+        if weekday not in valid_days:
+            raise ValueError(f"weekday 必須是 {valid_days} 之一: {weekday!r}")
+        if not isinstance(time_slot, str) or not time_slot.strip():
+            raise ValueError(f"time_slot 不可為空: {time_slot!r}")
+        if not isinstance(course_name, str) or not course_name.strip():
+            raise ValueError(f"course_name 不可為空: {course_name!r}")
+
+    user_ids = list({row[0] for row in rows})
+    supabase_url = os.getenv('DATABASE_URL')
+    conn = psycopg2.connect(supabase_url)
+    try:
+        with conn, conn.cursor() as cur:
+            # 匯入即覆蓋：先清掉這些使用者原本的課表，再批次寫入
+            cur.execute("DELETE FROM student_schedule WHERE user_id = ANY(%s)", (user_ids,))
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO student_schedule (user_id, weekday, time_slot, course_name, location) VALUES %s",
+                rows
+            )
+    finally:
+        conn.close()
+    return len(user_ids), len(rows)
+
+
+THINGSPEAK_RESULTS_MAX = 8000   # ThingSpeak 單次最多回傳的筆數
+THINGSPEAK_REFRESH_SECONDS = 60 # 距離上次更新不到這個秒數就直接用記憶體中的資料
+THINGSPEAK_FETCH_MARGIN = 20    # 多抓幾筆，避免兩次請求之間新寫入的資料把要抓的舊資料擠出範圍
+MAX_CHART_POINTS = 48           # 長時間範圍的圖表最多畫幾個點
+TAIPEI_TZ = timezone(timedelta(hours=8))
+
+
+class RingBuffer:
+    # 固定容量的環狀緩衝區，每個欄位各用一個 array 存放 (typecodes 例如 ('q', 'd'))
+    def __init__(self, capacity, typecodes):
+        self.capacity = capacity
+        self.columns = [array(typecode, [0]) * capacity for typecode in typecodes]
+        self.size = 0
+        self.head = 0  # 下一筆要寫入的位置
+
+    def append(self, *values):
+        for column, value in zip(self.columns, values):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def clear(self):
+        self.size = 0
+        self.head = 0
+
+    def index(self, back):
+        # back = 0 是最新一筆，back = 1 是前一筆，以此類推
+        return (self.head - 1 - back) % self.capacity
+
+
+class SensorSeries:
+    # 單一 ThingSpeak 欄位的本地時間序列
+    # 原始資料存在環狀緩衝區，另外每新增一筆就同步更新各層 (10 分鐘 / 1 小時 / 6 小時) 的最小/平均/最大值
+    def __init__(self, channel_env, api_key_env, capacity=16384,
+                 tier_seconds=(600, 3600, 21600), tier_capacity=1024):
+        self.channel_env = channel_env
+        self.api_key_env = api_key_env
+        self.raw = RingBuffer(capacity, ('q', 'd'))  # (時間, 數值)
+        # 每層的 bucket: (起始時間, 最小, 最大, 總和, 筆數)
+        self.tiers = [(seconds, RingBuffer(tier_capacity, ('q', 'd', 'd', 'd', 'q'))) for seconds in tier_seconds]
+        self.last_entry_id = 0
+        self.last_refresh = None
+        self._lock = threading.Lock()
+
+    def add(self, timestamp, value):
+        self.raw.append(timestamp, value)
+        for seconds, buckets in self.tiers:
+            start = timestamp - timestamp % seconds
+            i = buckets.index(0)
+            starts, mins, maxs, sums, counts = buckets.columns
+            if buckets.size and starts[i] == start:
+                mins[i] = min(mins[i], value)
+                maxs[i] = max(maxs[i], value)
+                sums[i] += value
+                counts[i] += 1
+            else:
+                buckets.append(start, value, value, value, 1)
+
+    def refresh(self):
+        # 只抓上次看到的 entry_id 之後的新資料
+        if self.last_refresh is not None and time.monotonic() - self.last_refresh < THINGSPEAK_REFRESH_SECONDS:
+            return
+
+        channel_id = os.getenv(self.channel_env)
+        read_api_key = os.getenv(self.api_key_env)
+        ts_url = f'https://api.thingspeak.com/channels/{channel_id}/fields/1.json?api_key={read_api_key}&timezone=Asia/Taipei'
+
+        last_entry_id = fetch_json(f'{ts_url}&results=1')['channel'].get('last_entry_id') or 0
+        if last_entry_id < self.last_entry_id:
+            # 頻道被清空或重建，entry_id 從頭開始，清掉本地資料後重新抓取
+            with self._lock:
+                self.raw.clear()
+                for seconds, buckets in self.tiers:
+                    buckets.clear()
+                self.last_entry_id = 0
+        new_count = last_entry_id - self.last_entry_id
+        if new_count > 0:
+            # 已看過的 entry_id 會被略過，所以多抓的部分不會重複寫入
+            results = min(new_count + THINGSPEAK_FETCH_MARGIN, self.raw.capacity, THINGSPEAK_RESULTS_MAX)
+            feeds = fetch_json(f'{ts_url}&results={results}').get('feeds', [])
+            with self._lock:
+                for f in feeds:
+                    if f["entry_id"] <= self.last_entry_id:
+                        continue
+                    self.last_entry_id = f["entry_id"]
+                    if f["field1"]:  # 空值不存，避免拉低最小值和平均
+                        timestamp = int(datetime.fromisoformat(f["created_at"]).timestamp())
+                        self.add(timestamp, float(f["field1"]))
+        self.last_refresh = time.monotonic()
+
+    def window(self, range_seconds=None, results_num=8):
+        # 回傳 [(時間, 最小, 平均, 最大), ...]，由舊到新
+        # range_seconds 為 None 時回傳最近 results_num 筆原始資料；否則挑選點數不超過 MAX_CHART_POINTS 的最細層級
+        with self._lock:
+            raw_times, raw_values = self.raw.columns
+            if self.raw.size == 0:
+                return []
+
+            if range_seconds is None:
+                count = min(results_num, self.raw.size)
+                rows = []
+                for back in range(count):
+                    i = self.raw.index(back)
+                    rows.append((raw_times[i], raw_values[i], raw_values[i], raw_values[i]))
+                return rows[::-1]
+
+            cutoff = raw_times[self.raw.index(0)] - range_seconds
+
+            # 範圍內的原始資料不超過 MAX_CHART_POINTS 筆就直接畫原始資料
+            if self.raw.size <= MAX_CHART_POINTS or raw_times[self.raw.index(MAX_CHART_POINTS)] < cutoff:
+                rows = []
+                for back in range(min(MAX_CHART_POINTS, self.raw.size)):
+                    i = self.raw.index(back)
+                    if raw_times[i] < cutoff:
+                        break
+                    rows.append((raw_times[i], raw_values[i], raw_values[i], raw_values[i]))
+                return rows[::-1]
+
+            seconds, buckets = next(((s, b) for s, b in self.tiers if s * MAX_CHART_POINTS >= range_seconds), self.tiers[-1])
+            starts, mins, maxs, sums, counts = buckets.columns
+            rows = []
+            for back in range(min(MAX_CHART_POINTS, buckets.size)):
+                i = buckets.index(back)
+                if starts[i] + seconds <= cutoff:
+                    break
+                rows.append((starts[i], mins[i], sums[i] / counts[i], maxs[i]))
+            return rows[::-1]
+
+
+temp_series = SensorSeries('THINKSPEAK_TEMP_CHANNEL_ID', 'THINKSPEAK_TEMP_READ_API_KEY')
+humidity_series = SensorSeries('THINKSPEAK_HUMIDITY_CHANNEL_ID', 'THINKSPEAK_HUMIDITY_READ_API_KEY')
+
+
+def thingspeak_chart_url(series, label, title, range_seconds=None):
+    # 1. 從本地時間序列取出資料 (必要時才向 ThingSpeak 抓新資料)
+    single_flight.do(('thingspeak', series.channel_env), series.refresh)
+    rows = series.window(range_seconds)
 
-def get_thingspeak_humidity_chart_url():
-    # 1. 設定 ThingSpeak 參數
-    channel_id = os.getenv('THINKSPEAK_HUMIDITY_CHANNEL_ID')
-    read_api_key = os.getenv('THINKSPEAK_HUMIDITY_READ_API_KEY')
-    RESULTS_NUM = 8  # 想要顯示最近的幾筆資料
-    
-    # 取得 ThingSpeak 原始數據 (JSON)
-    ts_url = f'https://api.thingspeak.com/channels/{channel_id}/fields/1.json?api_key={read_api_key}&results={RESULTS_NUM}&timezone=Asia/Taipei'
-    response = requests.get(ts_url).json()
-    
     # 解析數據
-    feeds = response.get('feeds', [])
-    labels = [f["created_at"][11:16] for f in feeds]  # 取得時間 (例如 14:30)
-    data = [float(f["field1"]) if f["field1"] else 0 for f in feeds] # 取得數值
-    
+    label_format = '%H:%M' if range_seconds is None or range_seconds < 86400 else '%m/%d %H:%M'
+    labels = [datetime.fromtimestamp(row[0], TAIPEI_TZ).strftime(label_format) for row in rows]  # 取得時間 (例如 14:30)
+    data = [round(row[2], 2) for row in rows] # 取得數值 (降採樣時為平均值)
+
+    datasets = [{
+        "label": label,
+        "data": data,
+        "fill": True,
+        "backgroundColor": "rgba(54, 162, 235, 0.2)",
+        "borderColor": "rgb(54, 162, 235)",
+        "borderWidth": 2
+    }]
+    # 長時間範圍額外畫出每段時間的最小值與最大值
+    if range_seconds is not None:
+        for name, column, color in (("最小", 1, "rgb(75, 192, 192)"), ("最大", 3, "rgb(255, 99, 132)")):
+            datasets.append({
+                "label": f"{label}{name}",
+                "data": [round(row[column], 2) for row in rows],
+                "fill": False,
+                "borderColor": color,
+                "borderWidth": 1,
+                "pointRadius": 0
+            })
+
     # 2. 設定 QuickChart 配置 (Chart.js 語法)
     chart_config = {
         "type": "line",
         "data": {
             "labels": labels,
-            "datasets": [{
-                "label": "濕度(°C)",
-                "data": data,
-                "fill": True,
-                "backgroundColor": "rgba(54, 162, 235, 0.2)",
-                "borderColor": "rgb(54, 162, 235)",
-                "borderWidth": 2
-            }]
+            "datasets": datasets
         },
         "options": {
             "title": { 
                 "display": True,
-                "text": "ThingSpeakg濕度數據"
+                "text": title
             },
             "scales": {
                 "yAxes": [{
@@ -188,63 +616,310 @@ def get_thingspeak_humidity_chart_url():
     return quickchart_url
 
 
-def weather(address):
+# range_seconds 為 None 時顯示最近 8 筆資料，例如 86400 為最近 24 小時、604800 為最近 7 天
+def get_thingspeak_temp_chart_url(range_seconds=None):
+    return thingspeak_chart_url(temp_series, "溫度(°C)", "ThingSpeak溫度數據", range_seconds)
+
+
+def get_thingspeak_humidity_chart_url(range_seconds=None):
+    return thingspeak_chart_url(humidity_series, "濕度(°C)", "ThingSpeakg濕度數據", range_seconds)
+
+
+STATION_TTL_SECONDS = float(os.getenv('STATION_TTL_SECONDS', '300'))  # 測站資料重新抓取的間隔
+LOCATION_CACHE_PERSIST = os.getenv('LOCATION_CACHE_PERSIST', '').lower() in ('1', 'true', 'yes', 'on')  # 開啟後地點解析結果會存進資料庫，讓各 instance 共用
+LOCATION_GRID_DIGITS = 2  # 座標四捨五入到小數第 2 位 (約 1 公里的格點)
+
+
+class LocationCache:
+    # 地點解析快取 (LRU)：正規化地址、地址前綴 (縣市+鄉鎮市區)、座標格點 → 測站 ID
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # Key: (測站種類, key 種類, key), Value: 測站 ID (找不到為 None)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # 回傳 (是否命中, 測站 ID)
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, self._entries[key]
+
+    def put(self, key, station_id):
+        with self._lock:
+            self._entries[key] = station_id
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)  # 淘汰最久沒用到的
+
+    def rebuild(self, kind):
+        # 測站清單變動時，清掉該種類的所有解析結果
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == kind]:
+                del self._entries[key]
+
+
+location_cache = LocationCache()
+
+
+class StationIndex:
+    # 測站清單與 ID 索引，超過 STATION_TTL_SECONDS 才需要重新抓取
+    # 清單的 fingerprint 改變 (新增/移除測站) 時自動重建地點解析快取
+    def __init__(self, kind, id_field, scan):
+        self.kind = kind
+        self.id_field = id_field
+        self.scan = scan  # scan(stations, address) → 測站 ID，快取沒命中時才會用到
+        self.stations = []
+        self.by_id = {}
+        self.fingerprint = None
+        self.updated_at = None
+
+    def is_stale(self):
+        return self.updated_at is None or time.monotonic() - self.updated_at >= STATION_TTL_SECONDS
+
+    def update(self, stations):
+        by_id = {}
+        for station in stations:
+            by_id.setdefault(str(station[self.id_field]), station)
+        fingerprint = hashlib.sha1('\n'.join(str(s[self.id_field]) for s in stations).encode('utf-8')).hexdigest()
+
+        if fingerprint != self.fingerprint:
+            location_cache.rebuild(self.kind)
+            if LOCATION_CACHE_PERSIST:
+                delete_stale_locations(self.kind, fingerprint)
+
+        self.stations = stations
+        self.by_id = by_id
+        self.fingerprint = fingerprint
+        self.updated_at = time.monotonic()
+
+
+def scan_weather_station(stations, address):
+    for i in stations:
+        # 使用「縣市+區域」比對，例如「高雄市前鎮區」
+        if f"{i['GeoInfo']['CountyName']}{i['GeoInfo']['TownName']}" in address:
+            return str(i['StationId'])
+    return None
+
+
+def scan_air_quality_site(stations, address):
+    for item in stations:
+        # 檢查測站的縣市和名稱有沒有出現在你的地址裡
+        # (因為 API 的 sitename 通常沒有「區」，所以這樣比對最準)
+        if item['county'] in address and item['sitename'] in address:
+            return str(item['siteid'])
+    return None
+
+
+weather_stations = StationIndex('weather', 'StationId', scan_weather_station)
+air_quality_sites = StationIndex('air_quality', 'siteid', scan_air_quality_site)
+
+
+def normalize_address(address):
+    # 「台」換成「臺」，去掉空白、開頭的郵遞區號與「臺灣」，同一地點的不同寫法會得到相同的 key
+    address = address.replace('台','臺').replace(' ', '')
+    return re.sub(r'^\d*(臺灣省?)?', '', address)
+
+
+def address_prefix(address):
+    # 取出「縣市+鄉鎮市區」，例如「苗栗縣苗栗市」
+    match = re.match(r'^(.{2}[縣市].{1,3}?[鄉鎮市區])', address)
+    return match.group(1) if match else None
+
+
+LOCATION_CACHE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS location_cache (
+        kind TEXT NOT NULL,
+        key_type TEXT NOT NULL,
+        cache_key TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        station_id TEXT,
+        PRIMARY KEY (kind, key_type, cache_key)
+    )
+"""
+location_cache_conn = None  # 地點快取共用的資料庫連線，第一次使用時才建立 (同時建立資料表)
+location_cache_conn_lock = threading.Lock()
+
+
+def run_location_cache_sql(func):
+    # 在共用連線上執行 func(cur)，失敗時關掉連線，下次使用再重新連線
+    global location_cache_conn
+    with location_cache_conn_lock:
+        try:
+            if location_cache_conn is None or location_cache_conn.closed:
+                location_cache_conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+                with location_cache_conn, location_cache_conn.cursor() as cur:
+                    cur.execute(LOCATION_CACHE_TABLE_SQL)
+            with location_cache_conn, location_cache_conn.cursor() as cur:
+                return func(cur)
+        except Exception as e:
+            print(f"資料庫錯誤: {e}")
+            if location_cache_conn is not None:
+                location_cache_conn.close()
+                location_cache_conn = None
+            return None
+
+
+def load_persisted_locations(keys, fingerprint):
+    kind = keys[0][0]
+
+    def load(cur):
+        sql = """
+            SELECT key_type, cache_key, station_id
+            FROM location_cache
+            WHERE kind = %s AND fingerprint = %s AND (key_type, cache_key) IN %s
+        """
+        cur.execute(sql, (kind, fingerprint, tuple((key[1], key[2]) for key in keys)))
+        return {(kind, key_type, cache_key): station_id for key_type, cache_key, station_id in cur.fetchall()}
+
+    return run_location_cache_sql(load) or {}
+
+
+def save_persisted_locations(entries, fingerprint):
+    def save(cur):
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO location_cache (kind, key_type, cache_key, fingerprint, station_id) VALUES %s
+            ON CONFLICT (kind, key_type, cache_key)
+            DO UPDATE SET fingerprint = EXCLUDED.fingerprint, station_id = EXCLUDED.station_id
+            """,
+            [(kind, key_type, cache_key, fingerprint, station_id)
+             for (kind, key_type, cache_key), station_id in entries.items()]
+        )
+
+    run_location_cache_sql(save)
+
+
+def delete_stale_locations(kind, fingerprint):
+    def delete(cur):
+        cur.execute("DELETE FROM location_cache WHERE kind = %s AND fingerprint <> %s", (kind, fingerprint))
+
+    run_location_cache_sql(delete)
+
+
+def resolve_station(index, address, latitude=None, longitude=None):
+    # 1. 地址開頭有「縣市+鄉鎮市區」(前綴) 且前綴就能比對到測站時，一律用前綴的結果，
+    #    同一鄉鎮市區的地址不論查詢順序都得到相同測站
+    #    (例如「臺北市中山區松山路」會對應到中山測站，而不是清單中較前面的松山測站)
+    # 2. 沒有可用的前綴時，和原本一樣掃描完整地址
+    # 3. 地址比對不到任何測站時，才用座標格點當備援 (格點只存前綴比對出來的測站)
+    address = normalize_address(address)
+    prefix = address_prefix(address)
+    address_key = (index.kind, 'address', address)
+    prefix_key = (index.kind, 'prefix', prefix) if prefix else None
+    grid_key = None
+    if latitude is not None and longitude is not None:
+        grid_key = (index.kind, 'grid', f'{round(latitude, LOCATION_GRID_DIGITS)},{round(longitude, LOCATION_GRID_DIGITS)}')
+    keys = [key for key in (address_key, prefix_key, grid_key) if key is not None]
+
+    cached = {}  # Key: 快取 key, Value: 測站 ID (找不到為 None)
+    missing = []
+    for key in keys:
+        found, station_id = location_cache.get(key)
+        if found:
+            cached[key] = station_id
+        else:
+            missing.append(key)
+
+    def cached_station():
+        for key in (address_key, prefix_key):
+            if cached.get(key) is not None:
+                return cached[key]
+        return None
+
+    station_id = cached_station()
+    if station_id is not None:
+        return station_id
+
+    # 只向資料庫查詢記憶體中沒有的 key
+    if LOCATION_CACHE_PERSIST and missing:
+        persisted = load_persisted_locations(missing, index.fingerprint)
+        for key, value in persisted.items():
+            location_cache.put(key, value)
+            cached[key] = value
+        station_id = cached_station()
+        if station_id is not None:
+            return station_id
+
+    # 完整地址還沒確定找不到時，才掃描測站清單
+    if address_key not in cached:
+        entries = {}
+        if prefix:
+            station_id = index.scan(index.stations, prefix)
+        if station_id is not None:
+            entries[prefix_key] = station_id
+            if grid_key is not None:
+                entries[grid_key] = station_id
+        else:
+            station_id = index.scan(index.stations, address)
+        entries[address_key] = station_id
+
+        for key, value in entries.items():
+            location_cache.put(key, value)
+            cached[key] = value
+        if LOCATION_CACHE_PERSIST:
+            save_persisted_locations(entries, index.fingerprint)
+        if station_id is not None:
+            return station_id
+
+    # 地址比對不到測站，用座標格點當備援
+    return cached.get(grid_key) if grid_key is not None else None
+
+
+def weather_urls():
+    owa_api_key = os.getenv('OPEN_WEATHER_DATA_API_KEY')
+    return [f'https://opendata.cwa.gov.tw/api/v1/rest/datastore/O-A0001-001?Authorization={owa_api_key}']
+
+
+def format_weather(address, latitude=None, longitude=None):
+    station_id = resolve_station(weather_stations, address, latitude, longitude)
+    i = weather_stations.by_id.get(station_id)
+    if i is None:
+        return '找不到氣象資訊'
+
+    weather = i['WeatherElement']['Weather']
+    temp = i['WeatherElement']['AirTemperature'] 
+    humid = i['WeatherElement']['RelativeHumidity']
+    return f'「{address}」目前天氣狀況「{weather}」，溫度 {temp} 度，相對濕度 {humid}%!'
+
+
+def weather(address, latitude=None, longitude=None):
     try:
-        owa_api_key = os.getenv('OPEN_WEATHER_DATA_API_KEY')
-        url = [f'https://opendata.cwa.gov.tw/api/v1/rest/datastore/O-A0001-001?Authorization={owa_api_key}']
-        result = {}
-        for item in url:
-            req = requests.get(item)   # 爬取目前天氣網址的資料
-            data = req.json()
-            station = data['records']['Station']   # 觀測站
-            for i in station:
-                city = i['GeoInfo']['CountyName']  # 縣市
-                area = i['GeoInfo']['TownName']    # 區域
-                # 使用「縣市+區域」作為 key，例如「高雄市前鎮區」就是 key
-                # 如果 result 裡沒有這個 key，就記錄相關資訊
-                if not f'{city}{area}' in result:
-                    weather = i['WeatherElement']['Weather']
-                    temp = i['WeatherElement']['AirTemperature'] 
-                    humid = i['WeatherElement']['RelativeHumidity']
-                    # 回傳結果
-                    result[f'{city}{area}'] = f'目前天氣狀況「{weather}」，溫度 {temp} 度，相對濕度 {humid}%!'
-
-        output = '找不到氣象資訊'
-        for i in result:
-            if i in address: # 如果地址裡存在 key 的名稱
-                output = f'「{address}」{result[i]}'
-                break
+        if weather_stations.is_stale():
+            # 爬取目前天氣網址的資料
+            datasets = [single_flight.do(item, fetch_json, item) for item in weather_urls()]
+            weather_stations.update([i for data in datasets for i in data['records']['Station']])
+        output = format_weather(address, latitude, longitude)
     except Exception as e:
         print(e)
         output = '抓取失敗...'
     return output
 
 
-def air_quality(address):
-    try:
-        moe_api_key = os.getenv('MINISTRY_OF_ENVIRONMENT_API_KEY')
-        url = f'https://data.moenv.gov.tw/api/v2/aqx_p_432?language=zh&offset=0&limit=1000&api_key={moe_api_key}'
-        
-        req = requests.get(url)
-        data = req.json()
+def air_quality_url():
+    moe_api_key = os.getenv('MINISTRY_OF_ENVIRONMENT_API_KEY')
+    return f'https://data.moenv.gov.tw/api/v2/aqx_p_432?language=zh&offset=0&limit=1000&api_key={moe_api_key}'
 
-        output = '找不到對應的空氣品質資訊'
 
-        for item in data:
-            county = item['county']      # 縣市 (ex: 臺北市)
-            sitename = item['sitename']  # 測站名稱 (ex: 松山)
-            
-            # 檢查測站的縣市和名稱有沒有出現在你的地址裡
-            # (因為 API 的 sitename 通常沒有「區」，所以這樣比對最準)
-            if county in address and sitename in address:
-                aqi_str = item['aqi']
-                aqi = int(aqi_str)
-                status = item['status']
-                
-                output = f'「{address}」目前的AQI：{aqi}，空氣品質：{status}'
-                    
-                break # 找到了就結束尋找，不用再往下跑迴圈
-            
+def format_air_quality(address, latitude=None, longitude=None):
+    site_id = resolve_station(air_quality_sites, address, latitude, longitude)
+    item = air_quality_sites.by_id.get(site_id)
+    if item is None:
+        return '找不到對應的空氣品質資訊'
+
+    aqi_str = item['aqi']
+    aqi = int(aqi_str)
+    status = item['status']
+    return f'「{address}」目前的AQI：{aqi}，空氣品質：{status}'
+
+
+def air_quality(address, latitude=None, longitude=None):
+    try:
+        if air_quality_sites.is_stale():
+            url = air_quality_url()
+            air_quality_sites.update(single_flight.do(url, fetch_json, url))
+        output = format_air_quality(address, latitude, longitude)
     except Exception as e:
         print(e)
         output = '抓取失敗...'
@@ -270,6 +945,29 @@ def callback():
     return 'OK'
 
 
+@app.route("/metrics")
+def metrics():
+    with admission_metrics_lock:
+        return dict(admission_metrics)
+
+
+@app.route("/import_enrolment", methods=['POST'])
+def import_enrolment_route():
+    # 只允許帶有正確匯入金鑰的請求寫入課表
+    import_token = os.getenv('ENROLMENT_IMPORT_TOKEN')
+    if not import_token or request.headers.get('X-Import-Token') != import_token:
+        abort(403)
+
+    try:
+        init_schedule_tables()
+        user_count, course_count = import_enrolment(request.get_json(force=True))
+    except (KeyError, TypeError, ValueError) as e:
+        app.logger.info(f"Invalid enrolment payload: {e}")
+        abort(400)
+
+    return f'Imported {course_count} courses for {user_count} users'
+
+
 @app.route("/create_rich_menu")
 def create_rich_menu():
     with ApiClient(configuration) as api_client:
@@ -466,63 +1164,256 @@ def create_rich_menu():
 
     return 'Rich menu created'
 
+# 定義有效的星期列表 (用來檢查使用者輸入是否合法)
+valid_days = [
+    "星期一", "星期二", "星期三", "星期四", 
+    "星期五", "星期六", "星期日"
+]
+
+
+# 以下函式只負責組出回覆訊息，Flask (app.py) 與 ASGI (asgi.py) 兩種入口共用
+def follow_messages():
+    confirm_template = ConfirmTemplate(
+        text="你今天學程式了嗎",
+        actions=[
+            PostbackAction(label="是", data="study_yes"),
+            PostbackAction(label="否", data="study_no"),
+        ]
+    )
+    template_message = TemplateMessage(
+        alt_text='Confirm alt text',
+        template=confirm_template
+    )
+
+    emojis_list = [
+        Emoji(index=0, product_id="5ac22e85040ab15980c9b44f", emoji_id="008"),
+        Emoji(index=16, product_id="670e0cce840a8236ddd4ee4c", emoji_id="019"),
+        Emoji(index=18, product_id="5ac22e85040ab15980c9b44f", emoji_id="008")  
+    ]
+    return [TextMessage(text="$ 你好!歡迎加入聯大資訊工程系$ $", emojis=emojis_list),
+            template_message]
+
+
+def postback_messages(data):
+    if data == "study_yes":
+        return [TextMessage(text="很棒!請繼續保持")]
+    elif data == "study_no":
+        return [TextMessage(text="加油!每天進步一點點")]
+    return None
+
+
+def course_messages(day_name, course_rows):
+    reply_messages_list = []
+
+    if not course_rows:
+        reply_messages_list.append(TextMessage(text=f"{day_name}沒有課,可以好好休息!也別忘了要練習程式喔"))
+    else:
+        # 1. 先放一個標題
+        reply_messages_list.append(TextMessage(text=f"{day_name}的課表如下"))
+        # 2. 把查到的課程加入列表
+        for row in course_rows:
+            course_name = row[0]
+            time_slot = row[1]
+            location = row[2]
+                
+            msg_text = f"課程名稱: {course_name}\n時間: {time_slot}\n教室: {location}"
+            reply_messages_list.append(TextMessage(text=msg_text))
+
+    return reply_messages_list
+
+
+# 除了「星期幾」(需要查資料庫) 以外的文字訊息，回傳 None 代表不回覆
+def text_reply_messages(text, user_id):
+    # 1. 查詢課表：跳出 Quick Reply
+    if text == "查詢課表":
+        items = [
+            QuickReplyItem(action=MessageAction(label="星期一", text="星期一")),
+            QuickReplyItem(action=MessageAction(label="星期二", text="星期二")),
+            QuickReplyItem(action=MessageAction(label="星期三", text="星期三")),
+            QuickReplyItem(action=MessageAction(label="星期四", text="星期四")),
+            QuickReplyItem(action=MessageAction(label="星期五", text="星期五")),
+        ]
+        
+        return [
+            TextMessage(
+                text="請選擇想查詢的日期:",
+                quick_reply=QuickReply(items=items)
+            )
+        ]
+
+    # 2. 行事曆
+    elif text == "行事曆":
+        supabase_image_url_1 = "https://jfnhxrcdlhajyhuadxkx.supabase.co/storage/v1/object/public/picture/114-1Calendar.png"
+        supabase_image_url_2 = "https://jfnhxrcdlhajyhuadxkx.supabase.co/storage/v1/object/public/picture/114-2Calendar.png"
+
+        image_message_1 = ImageMessage(
+            original_content_url = supabase_image_url_1,            # 原始大小
+            preview_image_url = supabase_image_url_1
+        )
+        image_message_2 = ImageMessage(
+            original_content_url = supabase_image_url_2,            # 原始大小
+            preview_image_url = supabase_image_url_2
+        )
+
+        return [TextMessage(text="114學年行事曆(上下學期)")
+                , image_message_1, image_message_2]
+
+    # 3. 更多資訊
+    elif text == "更多資訊":
+        image_carousel_template = ImageCarouselTemplate(
+            columns=[
+                ImageCarouselColumn(
+                    image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/school_web.jpg',
+                    action = URIAction(
+                        label="訪問聯大總網",
+                        uri="https://www.nuu.edu.tw/"
+                    )
+                ),
+                ImageCarouselColumn(
+                    image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/imf.png',
+                    action = URIAction(
+                        label="訪問校務資訊系統",
+                        uri="https://eap10.nuu.edu.tw/Login.aspx?logintype=S"
+                    )
+                ),
+                ImageCarouselColumn(
+                    image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/csie.png',
+                    action = URIAction(
+                        label="訪問資工系網頁",
+                        uri="https://csie.nuu.edu.tw/"
+                    )
+                ),
+                ImageCarouselColumn(
+                    image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/fb.png',
+                    action = URIAction(
+                        label="訪問系學會fb",
+                        uri="https://www.facebook.com/CSIEofNUU/"
+                    )
+                ),
+                ImageCarouselColumn(
+                    image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/ig.jpg',
+                    action = URIAction(
+                        label="訪問系學會ig",
+                        uri="https://www.instagram.com/nuu_csie_/"
+                    )
+                )
+            ]
+        )
+        image_carousel_message = TemplateMessage(
+            alt_text='圖片傳播範本',
+            template=image_carousel_template
+        )
+
+        return [image_carousel_message]
+
+    # 4. 雷達迴波圖
+    elif text == "雷達迴波圖":
+        radar_image_url = f"https://cwaopendata.s3.ap-northeast-1.amazonaws.com/Observation/O-A0058-001.png?{time.time_ns()}"
+        
+        image_message = ImageMessage(
+            original_content_url = radar_image_url,
+            preview_image_url = radar_image_url            # 原始大小
+        )
+        return [TextMessage(text="雷達回波圖")
+                , image_message]
+
+    # 5. 天氣預報
+    elif text == "即時天氣":
+        user_states[user_id] = "weather" # 記錄狀態為看天氣
+            
+        # 建立一個請求位置的 QuickReply 按鈕
+        location_item = QuickReplyItem(
+            action=LocationAction(label="傳送我的位置")
+        )
+
+        return [TextMessage(text="請點擊下方按鈕，分享您目前的位置以查詢天氣：",
+                    quick_reply=QuickReply(items=[location_item]))]
+
+    # 6. 空氣品質
+    elif text == "空氣品質":
+        user_states[user_id] = "air_quality" # 記錄狀態為看空氣品質
+
+        location_item = QuickReplyItem(
+            action=LocationAction(label="傳送我的位置")
+        )
+
+        return [TextMessage(text="請點擊下方按鈕，分享您目前的位置以查詢空氣品質：",
+                    quick_reply=QuickReply(items=[location_item]))]
+
+    # 7. 其他訊息
+    else:
+        if text != "是" and text != "否":
+            return [TextMessage(text="我不清楚你在說什麼，可以看看下方資訊欄位喔")]
+        return None
+
+    """
+    # 4. 溫度
+    elif text == "溫度":
+        QuickChart_image_url = get_thingspeak_temp_chart_url()
+        
+        image_message = ImageMessage(
+            original_content_url = QuickChart_image_url,            # 原始大小
+            preview_image_url = QuickChart_image_url
+        )
+        # Line Bot 回傳圖片訊息
+        # 注意：original_content_url 與 preview_image_url 都必須是 HTTPS
+        return [TextMessage(text="溫度變化圖")
+                , image_message]
+
+    # 5. 濕度
+    elif text == "濕度":
+        QuickChart_image_url = get_thingspeak_humidity_chart_url()
+        
+        image_message = ImageMessage(
+            original_content_url = QuickChart_image_url,            # 原始大小
+            preview_image_url = QuickChart_image_url
+        )
+        # Line Bot 回傳圖片訊息
+        # 注意：original_content_url 與 preview_image_url 都必須是 HTTPS
+        return [TextMessage(text="濕度變化圖")
+                , image_message]
+    """
+
+
 # 加入好友事件
 @line_handler.add(FollowEvent)
+@skip_redelivered
+@admission_control
 def handle_follow(event):
     with ApiClient(configuration) as api_client:
         line_bot_api = MessagingApi(api_client)
 
-        confirm_template = ConfirmTemplate(
-            text="你今天學程式了嗎",
-            actions=[
-                PostbackAction(label="是", data="study_yes"),
-                PostbackAction(label="否", data="study_no"),
-            ]
-        )
-        template_message = TemplateMessage(
-            alt_text='Confirm alt text',
-            template=confirm_template
-        )
-
-        emojis_list = [
-            Emoji(index=0, product_id="5ac22e85040ab15980c9b44f", emoji_id="008"),
-            Emoji(index=16, product_id="670e0cce840a8236ddd4ee4c", emoji_id="019"),
-            Emoji(index=18, product_id="5ac22e85040ab15980c9b44f", emoji_id="008")  
-        ]
         line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages = [TextMessage(text="$ 你好!歡迎加入聯大資訊工程系$ $", emojis=emojis_list),
-                            template_message]
+                messages=follow_messages()
             )
         )
 
 
 # postback事件
 @line_handler.add(PostbackEvent)
+@skip_redelivered
+@admission_control
 def handle_postback(event):
     data = event.postback.data
     with ApiClient(configuration) as api_client:
         line_bot_api = MessagingApi(api_client)
 
-        if data == "study_yes":
-            line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text="很棒!請繼續保持")]
-            )
-        )
-        elif data == "study_no":
+        reply_messages_list = postback_messages(data)
+        if reply_messages_list:
             line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text="加油!每天進步一點點")]
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=reply_messages_list
+                )
             )
-        )
 
 
 # 位置事件
 @line_handler.add(MessageEvent, message=LocationMessageContent)
+@skip_redelivered
+@admission_control
 def handle_location_message(event):
     user_id = event.source.user_id # 取得使用者的 ID
 
@@ -534,12 +1425,15 @@ def handle_location_message(event):
         # 取得使用者先前的狀態，預設為 'unknown'
         current_state = user_states.get(user_id, "unknown")
 
+        latitude = event.message.latitude
+        longitude = event.message.longitude
+
         if current_state == "weather":
-            reply_text = weather(user_address)
+            reply_text = weather(user_address, latitude, longitude)
             user_states.pop(user_id, None)  # 查詢完畢後，清除狀態，避免影響下次操作
         
         elif current_state == "air_quality":
-            reply_text = air_quality(user_address)
+            reply_text = air_quality(user_address, latitude, longitude)
             user_states.pop(user_id, None)  # 查詢完畢後，清除狀態，避免影響下次操作
         
         line_bot_api.reply_message(
@@ -552,6 +1446,8 @@ def handle_location_message(event):
 
 # 訊息事件
 @line_handler.add(MessageEvent, message=TextMessageContent)
+@skip_redelivered
+@admission_control
 def handle_message(event):
     text = event.message.text
     user_id = event.source.user_id # 取得使用者的 ID
@@ -559,232 +1455,18 @@ def handle_message(event):
     with ApiClient(configuration) as api_client:
         line_bot_api = MessagingApi(api_client)
 
-        # 定義有效的星期列表 (用來檢查使用者輸入是否合法)
-        valid_days = [
-            "星期一", "星期二", "星期三", "星期四", 
-            "星期五", "星期六", "星期日"
-        ]
-
-        # 1. 查詢課表：跳出 Quick Reply
-        if text == "查詢課表":
-            items = [
-                QuickReplyItem(action=MessageAction(label="星期一", text="星期一")),
-                QuickReplyItem(action=MessageAction(label="星期二", text="星期二")),
-                QuickReplyItem(action=MessageAction(label="星期三", text="星期三")),
-                QuickReplyItem(action=MessageAction(label="星期四", text="星期四")),
-                QuickReplyItem(action=MessageAction(label="星期五", text="星期五")),
-            ]
-            
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[
-                        TextMessage(
-                            text="請選擇想查詢的日期:",
-                            quick_reply=QuickReply(items=items)
-                        )
-                    ]
-                )
-            )
-
         # 直接判斷：如果使用者輸入的是「星期幾」
-        elif text in valid_days:
+        if text in valid_days:
             # 不需要轉換了，直接拿 text (例如 "星期一") 去資料庫查
-            course_rows = get_courses_list(text)
-                
-            reply_messages_list = []
-
-            if not course_rows:
-                reply_messages_list.append(TextMessage(text=f"{text}沒有課,可以好好休息!也別忘了要練習程式喔"))
-            else:
-                # 1. 先放一個標題
-                reply_messages_list.append(TextMessage(text=f"{text}的課表如下"))
-                # 2. 把查到的課程加入列表
-                for row in course_rows:
-                    course_name = row[0]
-                    time_slot = row[1]
-                    location = row[2]
-                        
-                    msg_text = f"課程名稱: {course_name}\n時間: {time_slot}\n教室: {location}"
-                    reply_messages_list.append(TextMessage(text=msg_text))
-
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=reply_messages_list
-                )
-            )  
-
-        # 2. 行事曆
-        elif text == "行事曆":
-            supabase_image_url_1 = "https://jfnhxrcdlhajyhuadxkx.supabase.co/storage/v1/object/public/picture/114-1Calendar.png"
-            supabase_image_url_2 = "https://jfnhxrcdlhajyhuadxkx.supabase.co/storage/v1/object/public/picture/114-2Calendar.png"
-
-            image_message_1 = ImageMessage(
-                original_content_url = supabase_image_url_1,            # 原始大小
-                preview_image_url = supabase_image_url_1
-            )
-            image_message_2 = ImageMessage(
-                original_content_url = supabase_image_url_2,            # 原始大小
-                preview_image_url = supabase_image_url_2
-            )
-
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="114學年行事曆(上下學期)")
-                            , image_message_1, image_message_2]
-                )
-            ) 
-
-        # 3. 更多資訊
-        elif text == "更多資訊":
-            image_carousel_template = ImageCarouselTemplate(
-                columns=[
-                    ImageCarouselColumn(
-                        image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/school_web.jpg',
-                        action = URIAction(
-                            label="訪問聯大總網",
-                            uri="https://www.nuu.edu.tw/"
-                        )
-                    ),
-                    ImageCarouselColumn(
-                        image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/imf.png',
-                        action = URIAction(
-                            label="訪問校務資訊系統",
-                            uri="https://eap10.nuu.edu.tw/Login.aspx?logintype=S"
-                        )
-                    ),
-                    ImageCarouselColumn(
-                        image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/csie.png',
-                        action = URIAction(
-                            label="訪問資工系網頁",
-                            uri="https://csie.nuu.edu.tw/"
-                        )
-                    ),
-                    ImageCarouselColumn(
-                        image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/fb.png',
-                        action = URIAction(
-                            label="訪問系學會fb",
-                            uri="https://www.facebook.com/CSIEofNUU/"
-                        )
-                    ),
-                    ImageCarouselColumn(
-                        image_url='https://raw.githubusercontent.com/Ya-Fong/line-bot/main/public/ig.jpg',
-                        action = URIAction(
-                            label="訪問系學會ig",
-                            uri="https://www.instagram.com/nuu_csie_/"
-                        )
-                    )
-                ]
-            )
-            image_carousel_message = TemplateMessage(
-                alt_text='圖片傳播範本',
-                template=image_carousel_template
-            )
-
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[image_carousel_message]
-                )
-            )
-
-        # 4. 雷達迴波圖
-        elif text == "雷達迴波圖":
-            radar_image_url = f"https://cwaopendata.s3.ap-northeast-1.amazonaws.com/Observation/O-A0058-001.png?{time.time_ns()}"
-            
-            image_message = ImageMessage(
-                original_content_url = radar_image_url,
-                preview_image_url = radar_image_url            # 原始大小
-            )
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="雷達回波圖")
-                            , image_message]
-                )
-            )
-
-        # 5. 天氣預報
-        elif text == "即時天氣":
-            user_states[user_id] = "weather" # 記錄狀態為看天氣
-                
-            # 建立一個請求位置的 QuickReply 按鈕
-            location_item = QuickReplyItem(
-                action=LocationAction(label="傳送我的位置")
-            )
-
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="請點擊下方按鈕，分享您目前的位置以查詢天氣：",
-                        quick_reply=QuickReply(items=[location_item]))]
-                )
-            )
-
-        # 6. 空氣品質
-        elif text == "空氣品質":
-            user_states[user_id] = "air_quality" # 記錄狀態為看空氣品質
-
-            location_item = QuickReplyItem(
-                action=LocationAction(label="傳送我的位置")
-            )
-
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="請點擊下方按鈕，分享您目前的位置以查詢空氣品質：",
-                        quick_reply=QuickReply(items=[location_item]))]
-                )
-            )
-
-        # 7. 其他訊息
+            course_rows = single_flight.do(('courses', text, user_id), get_courses_list, text, user_id)
+            reply_messages_list = course_messages(text, course_rows)
         else:
-            if text != "是" and text != "否":
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="我不清楚你在說什麼，可以看看下方資訊欄位喔")]   
-                    )
-                )
+            reply_messages_list = text_reply_messages(text, user_id)
 
-        """
-        # 4. 溫度
-        elif text == "溫度":
-            QuickChart_image_url = get_thingspeak_temp_chart_url()
-            
-            image_message = ImageMessage(
-                original_content_url = QuickChart_image_url,            # 原始大小
-                preview_image_url = QuickChart_image_url
-            )
-            # Line Bot 回傳圖片訊息
-            # 注意：original_content_url 與 preview_image_url 都必須是 HTTPS
+        if reply_messages_list:
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text="溫度變化圖")
-                            , image_message]
-                )
-            )
-
-        # 5. 濕度
-        elif text == "濕度":
-            QuickChart_image_url = get_thingspeak_humidity_chart_url()
-            
-            image_message = ImageMessage(
-                original_content_url = QuickChart_image_url,            # 原始大小
-                preview_image_url = QuickChart_image_url
-            )
-            # Line Bot 回傳圖片訊息
-            # 注意：original_content_url 與 preview_image_url 都必須是 HTTPS
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="濕度變化圖")
-                            , image_message]
+                    messages=reply_messages_list
                 )
             )
-        """
-                
-
@@ -0,0 +1,321 @@
+# ASGI (asyncio) 版本的入口，事件處理結果與 app.py 的 Flask 版本相同
+# 啟動方式: uvicorn asgi:app
+# 所有 I/O (LINE 回覆、氣象署/環境部 API、Supabase) 都是非同步的，單一 instance 可同時處理大量事件
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+
+from linebot.v3.webhook import (
+    WebhookParser
+)
+from linebot.v3.exceptions import (
+    InvalidSignatureError
+)
+from linebot.v3.messaging import (
+    AsyncApiClient,
+    AsyncMessagingApi,
+    ReplyMessageRequest,
+    TextMessage
+)
+from linebot.v3.webhooks import (
+    FollowEvent,
+    PostbackEvent,
+    MessageEvent,
+    TextMessageContent,
+    LocationMessageContent
+)
+import os
+import asyncio
+import aiohttp
+import asyncpg
+
+from app import (
+    configuration,
+    user_states,
+    valid_days,
+    handled_events,
+    rate_limiter,
+    admission_metrics,
+    admission_metrics_lock,
+    count_admission,
+    MAX_INFLIGHT_EVENTS,
+    MAX_QUEUED_EVENTS,
+    QUEUE_WAIT_SECONDS,
+    follow_messages,
+    postback_messages,
+    course_messages,
+    text_reply_messages,
+    LOCATION_CACHE_PERSIST,
+    weather_stations,
+    air_quality_sites,
+    weather_urls,
+    format_weather,
+    air_quality_url,
+    format_air_quality
+)
+
+
+class AsyncSingleFlight:
+    # 與 app.SingleFlight 相同，但等待的是 asyncio 的 Future
+    def __init__(self):
+        self._calls = {}  # Key: key, Value: 進行中的 Future
+
+    async def do(self, key, func, *args):
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func(*args)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 沒有其他人在等時，避免 "exception was never retrieved" 警告
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._calls[key]
+            if not future.done():
+                # 帶頭的呼叫被取消時，讓等待中的呼叫以一般錯誤結束，不會永遠卡住
+                future.set_exception(RuntimeError(f"single-flight call for {key!r} was cancelled"))
+                future.exception()
+        return result
+
+
+class AsyncWorkQueue:
+    # 與 app.WorkQueue 相同，但用 asyncio.Semaphore 排隊
+    def __init__(self, max_inflight, max_queued, wait_seconds):
+        self.max_queued = max_queued
+        self.wait_seconds = wait_seconds
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._queued = 0
+
+    async def acquire(self):
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return True
+        if self._queued >= self.max_queued:
+            return False
+        self._queued += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.wait_seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._queued -= 1
+
+    def release(self):
+        self._slots.release()
+
+
+single_flight = AsyncSingleFlight()
+work_queue = AsyncWorkQueue(MAX_INFLIGHT_EVENTS, MAX_QUEUED_EVENTS, QUEUE_WAIT_SECONDS)
+parser = WebhookParser(os.getenv('CHANNEL_SECRET'))
+
+# 在 lifespan 中建立，整個 instance 共用
+http_session = None
+db_pool = None
+line_bot_api = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_session, db_pool, line_bot_api
+    async_api_client = AsyncApiClient(configuration)
+    line_bot_api = AsyncMessagingApi(async_api_client)
+    http_session = aiohttp.ClientSession()
+    # Supabase 的 pooler 不支援 prepared statement 快取，所以關掉
+    db_pool = await asyncpg.create_pool(os.getenv('DATABASE_URL'), min_size=1, max_size=10,
+                                        statement_cache_size=0)
+    try:
+        yield
+    finally:
+        await db_pool.close()
+        await http_session.close()
+        await async_api_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def fetch_json(url):
+    async with http_session.get(url) as response:
+        return await response.json(content_type=None)
+
+
+async def get_courses_list(day_name, user_id=None):
+    # 與 app.get_courses_list 相同的查詢，改用 asyncpg 的參數格式
+    sql = """
+        SELECT course_name, time_slot, location
+        FROM student_schedule
+        WHERE user_id = $1 AND weekday = $2
+        UNION ALL
+        SELECT course_name, time_slot, location
+        FROM schedule
+        WHERE weekday = $2
+          AND NOT EXISTS (SELECT 1 FROM student_schedule WHERE user_id = $1)
+        ORDER BY time_slot
+    """
+    try:
+        try:
+            rows = await db_pool.fetch(sql, user_id, day_name)
+        except asyncpg.exceptions.UndefinedTableError:
+            # 還沒匯入過個人課表，只查全班共用的 schedule
+            rows = await db_pool.fetch(
+                "SELECT course_name, time_slot, location FROM schedule WHERE weekday = $1 ORDER BY time_slot",
+                day_name
+            )
+        return [tuple(row) for row in rows] # 回傳原始資料列表 [(課名, 時間, 地點), (...)]
+    except Exception as e:
+        print(f"資料庫錯誤: {e}")
+        return []
+
+
+async def run_location_lookup(func, *args):
+    # 開啟地點快取持久化時會連資料庫 (psycopg2)，改在 thread 中執行避免卡住 event loop
+    if LOCATION_CACHE_PERSIST:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+async def weather(address, latitude=None, longitude=None):
+    try:
+        if weather_stations.is_stale():
+            datasets = await asyncio.gather(*[single_flight.do(url, fetch_json, url) for url in weather_urls()])
+            await run_location_lookup(weather_stations.update, [i for data in datasets for i in data['records']['Station']])
+        output = await run_location_lookup(format_weather, address, latitude, longitude)
+    except Exception as e:
+        print(e)
+        output = '抓取失敗...'
+    return output
+
+
+async def air_quality(address, latitude=None, longitude=None):
+    try:
+        if air_quality_sites.is_stale():
+            url = air_quality_url()
+            await run_location_lookup(air_quality_sites.update, await single_flight.do(url, fetch_json, url))
+        output = await run_location_lookup(format_air_quality, address, latitude, longitude)
+    except Exception as e:
+        print(e)
+        output = '抓取失敗...'
+    return output
+
+
+async def reply(event, messages):
+    await line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=messages
+        )
+    )
+
+
+async def event_messages(event):
+    user_id = event.source.user_id if event.source else None
+
+    # 加入好友事件
+    if isinstance(event, FollowEvent):
+        return follow_messages()
+
+    # postback事件
+    elif isinstance(event, PostbackEvent):
+        return postback_messages(event.postback.data)
+
+    # 位置事件
+    elif isinstance(event, MessageEvent) and isinstance(event.message, LocationMessageContent):
+        user_address = event.message.address.replace('台','臺')  # 取出地址資訊，並將「台」換成「臺」
+        current_state = user_states.get(user_id, "unknown")
+        latitude = event.message.latitude
+        longitude = event.message.longitude
+
+        if current_state == "weather":
+            reply_text = await weather(user_address, latitude, longitude)
+        elif current_state == "air_quality":
+            reply_text = await air_quality(user_address, latitude, longitude)
+        else:
+            return None
+        user_states.pop(user_id, None)  # 查詢完畢後，清除狀態，避免影響下次操作
+        return [TextMessage(text=reply_text)]
+
+    # 訊息事件
+    elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        text = event.message.text
+        if text in valid_days:
+            course_rows = await single_flight.do(('courses', text, user_id), get_courses_list, text, user_id)
+            return course_messages(text, course_rows)
+        return text_reply_messages(text, user_id)
+
+    return None
+
+
+def is_handled_event(event):
+    # 與 app.py 註冊的 line_handler 相同，其他事件 (取消好友、貼圖、圖片…) 不處理也不限流
+    if isinstance(event, (FollowEvent, PostbackEvent)):
+        return True
+    return isinstance(event, MessageEvent) and isinstance(event.message, (TextMessageContent, LocationMessageContent))
+
+
+async def handle_event(event):
+    if not is_handled_event(event):
+        return
+
+    # 與 app.skip_redelivered 相同：略過 LINE 重送的事件
+    event_id = event.webhook_event_id
+    if event_id and not handled_events.add(event_id):
+        print(f"Skip redelivered event: {event_id}")
+        return
+
+    try:
+        # 與 app.admission_control 相同：先做每位使用者的限流，再排隊等待處理
+        user_id = event.source.user_id if event.source else None
+        if user_id and not rate_limiter.allow(user_id):
+            count_admission('throttled')
+            await reply(event, [TextMessage(text="目前使用人數較多，請稍後再試一次")])
+            return
+        if not await work_queue.acquire():
+            count_admission('shed')
+            await reply(event, [TextMessage(text="目前使用人數較多，請稍後再試一次")])
+            return
+
+        count_admission('admitted')
+        try:
+            messages = await event_messages(event)
+            if messages:
+                await reply(event, messages)
+        finally:
+            work_queue.release()
+    except Exception:
+        handled_events.discard(event_id)  # 處理失敗時允許 LINE 重送後再處理一次
+        raise
+
+
+@app.post("/callback")
+async def callback(request: Request):
+    # get X-Line-Signature header value
+    signature = request.headers['X-Line-Signature']
+
+    # get request body as text
+    body = (await request.body()).decode()
+
+    # handle webhook body
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        raise HTTPException(status_code=400, detail="Invalid signature")
+
+    # 和 Flask 版本一樣，有事件處理失敗就回 500，讓 LINE 重送
+    # (其他已處理完的事件會被 handled_events 略過)
+    results = await asyncio.gather(*[handle_event(event) for event in events], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return 'OK'
+
+
+@app.get("/metrics")
+async def metrics():
+    with admission_metrics_lock:
+        return dict(admission_metrics)